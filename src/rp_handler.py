@@ -1,33 +1,191 @@
 import runpod
-from runpod.serverless.utils.rp_upload import get_boto_client
+from runpod.serverless.utils.rp_upload import extract_region_from_url
+from boto3 import session as boto3_session
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import json
-import urllib.request
-import urllib.parse
 import time
 import os
+import shutil
+import mmap
+import mimetypes
 import requests
-import base64
+import pybase64
 import uuid
+import secrets
 import logging
+import asyncio
+import functools
+import aiohttp
+import orjson
+import ijson
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+
+def get_log_level(name):
+    """
+    Return the name of a log level, falling back to INFO if there is no level of that name
+
+    Args:
+        name (str): The name of the log level, case-insensitive
+
+    Returns:
+        str: The name of the log level
+    """
+    name = name.upper()
+    # getLevelName maps known level names to their number
+    if isinstance(logging.getLevelName(name), int):
+        return name
+    return "INFO"
+
 
 logger = logging.getLogger("runpod comfyui handler")
 FMT = "%(filename)-20s:%(lineno)-4d %(asctime)s %(message)s"
-logging.basicConfig(level=logging.DEBUG, format=FMT, handlers=[logging.StreamHandler()])
+# Log level of the handler, the large job/prompt/output dumps are only logged at DEBUG
+LOG_LEVEL = get_log_level(os.environ.get("LOG_LEVEL", "INFO"))
+logging.basicConfig(level=LOG_LEVEL, format=FMT, handlers=[logging.StreamHandler()])
+logger.setLevel(LOG_LEVEL)
+if LOG_LEVEL != os.environ.get("LOG_LEVEL", "INFO").upper():
+    logger.warning("Unknown LOG_LEVEL %r, falling back to INFO", os.environ["LOG_LEVEL"])
 
 
 # Time to wait between API check attempts in milliseconds
 COMFY_API_AVAILABLE_INTERVAL_MS = 50
 # Maximum number of API check attempts
 COMFY_API_AVAILABLE_MAX_RETRIES = 500
-# Time to wait between poll attempts in milliseconds
+# Time to wait between poll attempts in milliseconds, used to derive the total polling time
 COMFY_POLLING_INTERVAL_MS = 250
-# Maximum number of poll attempts
+# Maximum number of poll attempts, used to derive the total polling time
 COMFY_POLLING_MAX_RETRIES = 500
+# Time to wait before the first repeated poll attempt in milliseconds
+COMFY_POLLING_MIN_INTERVAL_MS = 25
+# Upper bound for the time to wait between poll attempts in milliseconds
+COMFY_POLLING_MAX_INTERVAL_MS = 500
+# Factor by which the time between poll attempts grows after each attempt
+COMFY_POLLING_BACKOFF_FACTOR = 1.5
 # Host where ComfyUI is running
 COMFY_HOST = "127.0.0.1:8188"
+# Maximum number of pooled keep-alive connections to ComfyUI
+COMFY_CONNECTION_POOL_SIZE = 4
+# Time to wait for a connection to ComfyUI in seconds
+COMFY_CONNECT_TIMEOUT_S = 5
+# Time to wait for a complete response from ComfyUI in seconds
+COMFY_REQUEST_TIMEOUT_S = 60
+# Number of bytes read per chunk when base64 encoding an image, must be a multiple of 3
+BASE64_CHUNK_SIZE = 57 * 1024
+# Maximum number of images uploaded or encoded concurrently
+IMAGE_WORKERS_MAX = 8
+# Images larger than this many bytes are uploaded to the bucket in parts of this size
+UPLOAD_MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+# Maximum number of parts of a single image uploaded concurrently
+UPLOAD_MAX_CONCURRENCY = 4
+
+# Connections kept by a bucket client, enough for every part of every concurrently uploaded image
+BUCKET_MAX_POOL_CONNECTIONS = IMAGE_WORKERS_MAX * UPLOAD_MAX_CONCURRENCY
+
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=UPLOAD_MULTIPART_CHUNK_SIZE,
+    multipart_chunksize=UPLOAD_MULTIPART_CHUNK_SIZE,
+    max_concurrency=UPLOAD_MAX_CONCURRENCY,
+    use_threads=True,
+)
+
+
+
+@dataclass(frozen=True)
+class JobConfig:
+    """
+    Settings of a single job, resolved once when the job starts
+
+    Attributes:
+        bucket_endpoint_url (str): The endpoint URL of the bucket the images are uploaded to, if any
+        bucket_access_key_id (str): The access key ID for the bucket
+        bucket_secret_access_key (str): The secret access key for the bucket
+        bucket_name (str): The name of the bucket
+        output_path (str): The prefix of the keys the images are uploaded with
+        comfy_output_path (str): The folder in which ComfyUI stores the generated images
+    """
+    bucket_endpoint_url: str = None
+    bucket_access_key_id: str = None
+    bucket_secret_access_key: str = None
+    bucket_name: str = None
+    output_path: str = None
+    comfy_output_path: str = "/comfyui/output"
+
+
+def build_job_config(job_input):
+    """
+    Build the settings of a job from its input, falling back to the environment variables
+
+    Args:
+        job_input (dict): The input of the job, "bucket_creds" take precedence over the environment
+
+    Returns:
+        JobConfig: The settings of the job
+    """
+    bucket_creds = job_input.get("bucket_creds") or {}
+
+    return JobConfig(
+        bucket_endpoint_url=bucket_creds.get("endpointUrl") or os.environ.get("BUCKET_ENDPOINT_URL"),
+        bucket_access_key_id=bucket_creds.get("accessId") or os.environ.get("BUCKET_ACCESS_KEY_ID"),
+        bucket_secret_access_key=bucket_creds.get("accessSecret") or os.environ.get("BUCKET_SECRET_ACCESS_KEY"),
+        bucket_name=bucket_creds.get("bucketName") or os.environ.get("BUCKET_NAME"),
+        output_path=job_input.get("output_path"),
+        comfy_output_path=os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output"),
+    )
+
+
+# HTTP session shared by all requests to ComfyUI, created lazily by get_session()
+_session = None
+# Session for the websockets to ComfyUI, created lazily by get_websocket_session()
+_ws_session = None
+_session_lock = asyncio.Lock()
+# Whether ComfyUI has been reachable once, it keeps running for the lifetime of the worker
+_comfy_ready = False
+
+
+async def get_session():
+    """
+    Return the aiohttp session used to talk to ComfyUI, creating it on first use
+
+    Returns:
+        aiohttp.ClientSession: The module-wide client session
+    """
+    global _session
 
+    async with _session_lock:
+        if _session is None or _session.closed:
+            # Keep a small pool of keep-alive connections to the local ComfyUI server
+            _session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=COMFY_CONNECTION_POOL_SIZE),
+                timeout=aiohttp.ClientTimeout(connect=COMFY_CONNECT_TIMEOUT_S, total=COMFY_REQUEST_TIMEOUT_S),
+            )
+        return _session
 
-def check_server(url, retries=50, delay=500):
+
+async def get_websocket_session():
+    """
+    Return the aiohttp session used for websockets to ComfyUI, creating it on first use
+
+    A websocket keeps its connection for as long as its job waits, so the websockets don't
+    share the limited connection pool of get_session() and aren't limited in number.
+
+    Returns:
+        aiohttp.ClientSession: The module-wide websocket session
+    """
+    global _ws_session
+
+    async with _session_lock:
+        if _ws_session is None or _ws_session.closed:
+            _ws_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0),
+                timeout=aiohttp.ClientTimeout(connect=COMFY_CONNECT_TIMEOUT_S, total=COMFY_REQUEST_TIMEOUT_S),
+            )
+        return _ws_session
+
+
+async def check_server(url, retries=50, delay=500):
     """
     Check if a server is reachable via HTTP GET request
 
@@ -40,20 +198,21 @@ def check_server(url, retries=50, delay=500):
     bool: True if the server is reachable within the given number of retries, otherwise False
     """
 
+    session = await get_session()
+
     for i in range(retries):
         try:
-            response = requests.get(url)
-
-            # If the response status code is 200, the server is up and running
-            if response.status_code == 200:
-                print(f"runpod-worker-comfy - API is reachable")
-                return True
-        except requests.RequestException as e:
+            async with session.get(url) as response:
+                # If the response status code is 200, the server is up and running
+                if response.status == 200:
+                    print(f"runpod-worker-comfy - API is reachable")
+                    return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             # If an exception occurs, the server may not be ready
             pass
 
         # Wait for the specified delay before retrying
-        time.sleep(delay / 1000)
+        await asyncio.sleep(delay / 1000)
 
     print(
         f"runpod-worker-comfy - Failed to connect to server at {url} after {retries} attempts."
@@ -61,22 +220,45 @@ def check_server(url, retries=50, delay=500):
     return False
 
 
-def queue_prompt(prompt):
+async def open_websocket(client_id):
+    """
+    Open a websocket to ComfyUI on which it pushes the progress of the prompts queued by a client
+
+    Args:
+        client_id (str): The client ID the prompts are queued with
+
+    Returns:
+        aiohttp.ClientWebSocketResponse: The open websocket
+    """
+    session = await get_websocket_session()
+    return await session.ws_connect(f"ws://{COMFY_HOST}/ws?clientId={client_id}")
+
+
+async def queue_prompt(prompt, client_id=None):
     """
     Queue a prompt to be processed by ComfyUI
 
     Args:
         prompt (dict): A dictionary containing the prompt to be processed
+        client_id (str, optional): The client ID whose websocket receives the progress messages
 
     Returns:
         dict: The JSON response from ComfyUI after processing the prompt
     """
-    data = json.dumps(prompt).encode("utf-8")
-    req = urllib.request.Request(f"http://{COMFY_HOST}/prompt", data=data)
-    return json.loads(urllib.request.urlopen(req).read())
+    if client_id is not None:
+        prompt = {**prompt, "client_id": client_id}
+
+    # orjson serializes straight to bytes, without an intermediate str to encode
+    data = orjson.dumps(prompt)
+    session = await get_session()
+    async with session.post(
+        f"http://{COMFY_HOST}/prompt", data=data, headers={"Content-Type": "application/json"}
+    ) as response:
+        response.raise_for_status()
+        return orjson.loads(await response.read())
 
 
-def get_history(prompt_id):
+async def get_history(prompt_id):
     """
     Retrieve the history of a given prompt using its ID
 
@@ -84,10 +266,104 @@ def get_history(prompt_id):
         prompt_id (str): The ID of the prompt whose history is to be retrieved
 
     Returns:
-        dict: The history of the prompt, containing all the processing steps and results
+        dict: The history of the prompt reduced to its outputs, or an empty dict if it has none yet
+    """
+    history = {}
+
+    session = await get_session()
+    async with session.get(f"http://{COMFY_HOST}/history/{prompt_id}") as response:
+        response.raise_for_status()
+
+        # Parse the response while it streams in and only build the outputs of the prompt
+        async for outputs in ijson.items(response.content, f"{prompt_id}.outputs", use_float=True):
+            history[prompt_id] = {"outputs": outputs}
+
+    return history
+
+
+async def poll_history(prompt_id, max_wait_seconds):
+    """
+    Poll the history of a prompt until it contains outputs, backing off exponentially
+
+    Args:
+        prompt_id (str): The ID of the prompt to wait for
+        max_wait_seconds (float): The maximum time in seconds to keep polling
+
+    Returns:
+        dict: The history containing the outputs of the prompt, or None if the time ran out
+    """
+    delay = COMFY_POLLING_MIN_INTERVAL_MS / 1000
+    deadline = time.monotonic() + max_wait_seconds
+
+    while time.monotonic() < deadline:
+        history = await get_history(prompt_id)
+
+        # Exit the loop if we have found the history
+        if prompt_id in history and history[prompt_id].get("outputs"):
+            return history
+
+        # Wait before trying again, polling less often the longer the generation takes
+        await asyncio.sleep(delay)
+        delay = min(delay * COMFY_POLLING_BACKOFF_FACTOR, COMFY_POLLING_MAX_INTERVAL_MS / 1000)
+
+    return None
+
+
+async def wait_for_execution(ws, prompt_id):
+    """
+    Wait on a ComfyUI websocket until a prompt has been executed
+
+    Args:
+        ws (aiohttp.ClientWebSocketResponse): The websocket of the client that queued the prompt
+        prompt_id (str): The ID of the prompt to wait for
+
+    Returns:
+        bool: True once the prompt has been executed, False if the websocket closed before that
+    """
+    async for msg in ws:
+        # Binary messages are previews of the images being generated
+        if msg.type != aiohttp.WSMsgType.TEXT:
+            continue
+
+        message = orjson.loads(msg.data)
+        data = message.get("data", {})
+
+        # ComfyUI reports "executing" without a node once it is done with a prompt
+        if message.get("type") == "executing" and data.get("node") is None and data.get("prompt_id") == prompt_id:
+            return True
+
+    return False
+
+
+async def wait_for_history(prompt_id, ws, max_wait_seconds):
+    """
+    Wait until a prompt has been executed and retrieve its history
+
+    The completion is pushed by ComfyUI over the websocket, so the history is only requested
+    once. Without a websocket, or if it closes early, the history is polled instead.
+
+    Args:
+        prompt_id (str): The ID of the prompt to wait for
+        ws (aiohttp.ClientWebSocketResponse): The websocket of the client that queued the prompt, or None
+        max_wait_seconds (float): The maximum time in seconds to wait
+
+    Returns:
+        dict: The history of the prompt, or None if the time ran out
     """
-    with urllib.request.urlopen(f"http://{COMFY_HOST}/history/{prompt_id}") as response:
-        return json.loads(response.read())
+    deadline = time.monotonic() + max_wait_seconds
+
+    if ws is not None:
+        try:
+            executed = await asyncio.wait_for(wait_for_execution(ws, prompt_id), max_wait_seconds)
+        except asyncio.TimeoutError:
+            return None
+
+        if executed:
+            return await get_history(prompt_id)
+
+        print("runpod-worker-comfy - websocket closed, falling back to polling")
+
+    return await poll_history(prompt_id, deadline - time.monotonic())
 
 
 def base64_encode(img_path):
@@ -100,26 +376,88 @@ def base64_encode(img_path):
     Returns:
         str: The base64 encoded image
     """
+    prefix = b"data:image/png;base64,"
+
     with open(img_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-        return f"data:image/png;base64,{encoded_string}"
+        size = os.fstat(image_file.fileno()).st_size
+
+        # An empty file can't be mapped
+        if size == 0:
+            return prefix.decode("ascii")
+
+        # Allocate the data URI at its final size once, base64 turns every 3 bytes into 4
+        encoded = bytearray(len(prefix) + (size + 2) // 3 * 4)
+        encoded[:len(prefix)] = prefix
+        offset = len(prefix)
+
+        # Map the file instead of reading it, so the chunks are views on the page cache
+        # rather than copies. The chunk size is a multiple of 3, so every chunk encodes
+        # without padding
+        with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            view = memoryview(mapped_file)
+            try:
+                for start in range(0, size, BASE64_CHUNK_SIZE):
+                    chunk = pybase64.b64encode(view[start:start + BASE64_CHUNK_SIZE])
+                    encoded[offset:offset + len(chunk)] = chunk
+                    offset += len(chunk)
+            finally:
+                view.release()
+
+    # RunPod serializes the result to JSON, so it has to be returned as a string
+    return encoded.decode("ascii")
 
 
 
 # ---------------------------------------------------------------------------- #
 #                                 Upload Image                                 #
 # ---------------------------------------------------------------------------- #
-def upload_image(job_id, image_location, result_index=0, results_list=None, bucket=None):  # pragma: no cover
+@functools.lru_cache(maxsize=4)
+def get_bucket_client(endpoint_url, access_key_id, secret_access_key):
+    """
+    Return a boto client for a bucket, reusing the client created for the same credentials
+
+    The client is configured like the one from runpod's get_boto_client, but with a connection
+    pool that fits the images and parts that process_output_images uploads at the same time.
+
+    Args:
+        endpoint_url (str): The endpoint URL of the bucket
+        access_key_id (str): The access key ID for the bucket
+        secret_access_key (str): The secret access key for the bucket
+
+    Returns:
+        The boto client, or None if the bucket is not fully configured
+    """
+    if not (endpoint_url and access_key_id and secret_access_key):
+        return None
+
+    return boto3_session.Session().client(
+        "s3",
+        endpoint_url=endpoint_url,
+        aws_access_key_id=access_key_id,
+        aws_secret_access_key=secret_access_key,
+        config=Config(
+            signature_version="s3v4",
+            retries={"max_attempts": 3, "mode": "standard"},
+            max_pool_connections=BUCKET_MAX_POOL_CONNECTIONS,
+        ),
+        region_name=extract_region_from_url(endpoint_url),
+    )
+
+
+def upload_image(job_id, image_location, config=None, result_index=0, results_list=None, boto_client=None):
     '''
     Upload a single file to bucket storage.
     '''
-    image_name = str(uuid.uuid4())[:8]
-    boto_client, _ = get_boto_client()
-    file_extension = os.path.splitext(image_location)[1]
-    content_type = "image/" + file_extension.lstrip(".")
+    if config is None:
+        config = build_job_config({})
 
-    with open(image_location, "rb") as input_file:
-        output = input_file.read()
+    image_name = secrets.token_hex(4)
+    if boto_client is None:
+        boto_client = get_bucket_client(
+            config.bucket_endpoint_url, config.bucket_access_key_id, config.bucket_secret_access_key
+        )
+    file_extension = os.path.splitext(image_location)[1]
+    content_type = mimetypes.guess_type(image_location)[0] or "application/octet-stream"
 
     if boto_client is None:
         # Save the output to a file
@@ -130,24 +468,24 @@ def upload_image(job_id, image_location, result_index=0, results_list=None, buck
         os.makedirs("simulated_uploaded", exist_ok=True)
         sim_upload_location = f"simulated_uploaded/{image_name}{file_extension}"
 
-        with open(sim_upload_location, "wb") as file_output:
-            file_output.write(output)
+        shutil.copyfile(image_location, sim_upload_location)
 
         if results_list is not None:
             results_list[result_index] = sim_upload_location
 
         return sim_upload_location
 
-    if not bucket:
-        bucket = os.getenv("BUCKET_NAME")
-
+    bucket = config.bucket_name
     if not bucket:
         bucket = time.strftime('%m-%y')
-    boto_client.put_object(
-        Bucket=f'{bucket}',
-        Key=f'{job_id}/{image_name}{file_extension}',
-        Body=output,
-        ContentType=content_type
+
+    # Stream the file from disk, large images are uploaded in parallel parts
+    boto_client.upload_file(
+        image_location,
+        f'{bucket}',
+        f'{job_id}/{image_name}{file_extension}',
+        ExtraArgs={'ContentType': content_type},
+        Config=UPLOAD_TRANSFER_CONFIG
     )
 
     presigned_url = boto_client.generate_presigned_url(
@@ -163,7 +501,79 @@ def upload_image(job_id, image_location, result_index=0, results_list=None, buck
     return presigned_url
 
 
-def process_output_images(outputs, job_id, output_path = None):
+def get_output_image_paths(outputs, comfy_output_path):
+    """
+    Collect the paths of the images generated by ComfyUI and make sure that they exist
+
+    Args:
+        outputs (dict): A dictionary containing the outputs from image generation
+        comfy_output_path (str): The folder in which ComfyUI stores the generated images
+
+    Returns:
+        tuple: The list of image paths and None, or None and an error response naming the
+               first image that does not exist in the output folder
+    """
+    logger.info("Comfy image generation finished")
+    logger.debug("Comfy outputs: %s", outputs)
+
+    output_images = [
+        image["filename"]
+        for node_output in outputs.values()
+        for image in node_output.get("images", [])
+    ]
+
+    print(f"runpod-worker-comfy - image generation is done")
+
+    # Build the folder prefix once and append the filenames to it
+    base_path = comfy_output_path.rstrip("/") + "/"
+
+    # Read the output folder once instead of checking every image on its own
+    try:
+        existing_images = {entry.name for entry in os.scandir(comfy_output_path)}
+    except FileNotFoundError:
+        existing_images = set()
+
+    missing_images = [output_image for output_image in output_images if output_image not in existing_images]
+    if missing_images:
+        print("runpod-worker-comfy - the image does not exist in the output folder")
+        return None, {
+            "status": "error",
+            "message": f"the image does not exist in the specified output folder: {base_path + missing_images[0]}",
+        }
+
+    print("runpod-worker-comfy - the images exist in the output folder")
+
+    # expected image output folder
+    return [base_path + output_image for output_image in output_images], None
+
+
+async def stream_base64_images(outputs, config):
+    """
+    Encode the generated images in base64 one after another, yielding each as soon as it's done
+
+    Only one encoded image is held at a time, instead of the list of all of them that
+    process_output_images returns.
+
+    Args:
+        outputs (dict): A dictionary containing the outputs from image generation
+        config (JobConfig): The settings of the job
+
+    Yields:
+        dict: A success status with one base64 encoded image per generated image, or a single
+              error status if an image does not exist in the output folder
+    """
+    local_image_paths, error = get_output_image_paths(outputs, config.comfy_output_path)
+    if error is not None:
+        yield error
+        return
+
+    for local_image_path in local_image_paths:
+        # Encoding is blocking file I/O, so keep it off the event loop
+        image = await asyncio.to_thread(base64_encode, local_image_path)
+        yield {"status": "success", "message": image}
+
+
+def process_output_images(outputs, job_id, config=None):
     """
     This function takes the "outputs" from image generation and the job ID,
     then determines the correct way to return the image, either as a direct URL
@@ -174,6 +584,7 @@ def process_output_images(outputs, job_id, output_path = None):
         outputs (dict): A dictionary containing the outputs from image generation,
                         typically includes node IDs and their respective output data.
         job_id (str): The unique identifier for the job.
+        config (JobConfig, optional): The settings of the job. Defaults to the environment variables.
 
     Returns:
         dict: A dictionary with the status ('success' or 'error') and the message,
@@ -181,119 +592,86 @@ def process_output_images(outputs, job_id, output_path = None):
               encoded string of the image. In case of error, the message details the issue.
 
     The function works as follows:
-    - It first determines the output path for the images from an environment variable,
+    - It first determines the output path for the images from the job settings,
       defaulting to "/comfyui/output" if not set.
     - It then iterates through the outputs to find the filenames of the generated images.
     - After confirming the existence of the image in the output folder, it checks if the
-      AWS S3 bucket is configured via the BUCKET_ENDPOINT_URL environment variable.
+      AWS S3 bucket is configured via the job's bucket endpoint URL.
     - If AWS S3 is configured, it uploads the image to the bucket and returns the URL.
     - If AWS S3 is not configured, it encodes the image in base64 and returns the string.
     - If the image file does not exist in the output folder, it returns an error status
       with a message indicating the missing image file.
     """
 
-    # The path where ComfyUI stores the generated images
-    logger.info(f"\n\nComfy image generation finished. ")
-    print(f"Comfy Outputs: {outputs}")
-
-
-    COMFY_OUTPUT_PATH = os.environ.get('COMFY_OUTPUT_PATH', "/comfyui/output")
-    output_images = []
-
-    for node_id, node_output in outputs.items():
-        if "images" in node_output:
-            for image in node_output["images"]:
-                output_images.append(image["filename"])
-
-    print(f"runpod-worker-comfy - image generation is done")
-
-    # expected image output folder
-    local_image_paths = [f"{COMFY_OUTPUT_PATH}/{output_image}" for output_image in output_images]
-    images = []
+    if config is None:
+        config = build_job_config({})
+
+    local_image_paths, error = get_output_image_paths(outputs, config.comfy_output_path)
+    if error is not None:
+        return error
+
+    use_bucket = bool(config.bucket_endpoint_url)
+    boto_client = None
+    if use_bucket:
+        # Resolve the client before the workers start, so that they don't all build one on a cache miss
+        boto_client = get_bucket_client(
+            config.bucket_endpoint_url, config.bucket_access_key_id, config.bucket_secret_access_key
+        )
+
+    def process_image(local_image_path):
+        if use_bucket:
+            # URL to image in AWS S3
+            image = upload_image(config.output_path, local_image_path, config, boto_client=boto_client)
+            print(f"image saved in aws bucket: {image}")
+            return image
+        else:
+            # base64 image
+            return base64_encode(local_image_path)
 
-    for local_image_path in local_image_paths:
-        # The image is in the output folder
-        if os.path.exists(local_image_path):
-            print("runpod-worker-comfy - the image exists in the output folder")
-
-            if os.environ.get('BUCKET_ENDPOINT_URL', False):
-                # URL to image in AWS S3
-                image = upload_image(output_path, local_image_path)
-                print(f"image saved in aws bucket: {image}")
-                images.append(image)
-            else:
-                # base64 image
-                image = base64_encode(local_image_path)
-                images.append(image)
+    # Uploading/encoding the images is independent I/O, so run it concurrently
+    with ThreadPoolExecutor(max_workers=max(1, min(IMAGE_WORKERS_MAX, len(local_image_paths)))) as executor:
+        images = list(executor.map(process_image, local_image_paths))
 
-        else:
-            print("runpod-worker-comfy - the image does not exist in the output folder")
-            return {
-                "status": "error",
-                "message": f"the image does not exist in the specified output folder: {local_image_path}",
-            }
-    
     return {
         "status": "success",
         "message": images
     }
     
 
-def handler(job):
+async def generate_images(job_input, config):
     """
-    The main function that handles a job of generating an image.
-
-    This function validates the input, sends a prompt to ComfyUI for processing,
-    polls ComfyUI for result, and retrieves generated images.
+    Validate the input of a job, queue its prompt in ComfyUI and wait for the generated images
 
     Args:
-        job (dict): A dictionary containing job details and input parameters.
+        job_input (dict): The input of the job
+        config (JobConfig): The settings of the job
 
     Returns:
-        dict: A dictionary containing either an error message or a success status with generated images.
+        tuple: The outputs of the prompt and None, or None and an error response
     """
-    job_input = job["input"]
-
-    logger.info(f"""
-
-    
-
-    Start handler ...
-    job: {job}
-
-
-        
-    """)
-
-    if "bucket_creds" in job_input:
-        bucket_creds = job_input.pop("bucket_creds")
-        os.environ["BUCKET_ENDPOINT_URL"] = bucket_creds.get("endpointUrl")
-        os.environ["BUCKET_ACCESS_KEY_ID"] = bucket_creds.get("accessId")
-        os.environ["BUCKET_SECRET_ACCESS_KEY"] = bucket_creds.get("accessSecret")
-        os.environ["BUCKET_NAME"] = bucket_creds.get("bucketName")
-
     polling_max_retries = job_input.get("polling_max_retries", COMFY_POLLING_MAX_RETRIES)
-    output_path = job_input.get("output_path")
 
-    print(f"Polling max retries: {polling_max_retries}\nOutput path: {output_path}")
+    print(f"Polling max retries: {polling_max_retries}\nOutput path: {config.output_path}")
 
-    # Make sure that the ComfyUI API is available
-    check_server(
-        f"http://{COMFY_HOST}",
-        COMFY_API_AVAILABLE_MAX_RETRIES,
-        COMFY_API_AVAILABLE_INTERVAL_MS,
-    )
+    # Make sure that the ComfyUI API is available, only needed until it was reachable once
+    global _comfy_ready
+    if not _comfy_ready:
+        _comfy_ready = await check_server(
+            f"http://{COMFY_HOST}",
+            COMFY_API_AVAILABLE_MAX_RETRIES,
+            COMFY_API_AVAILABLE_INTERVAL_MS,
+        )
 
     # Validate input
     if job_input is None:
-        return {"error": "Please provide the 'prompt'"}
+        return None, {"error": "Please provide the 'prompt'"}
 
     # Is JSON?
     if isinstance(job_input, dict):
         if "comfy_input" in job_input:
             prompt = job_input["comfy_input"]
         else:
-            print("comfyui not in job_input, job_input:", job_input)
+            logger.debug("comfy_input not in job_input, job_input: %s", job_input)
             prompt = job_input
     # Is String?
     elif isinstance(job_input, str):
@@ -302,49 +680,128 @@ def handler(job):
             if "comfy_input" in prompt:
                 prompt  = prompt["comfy_input"]
             else:
-                print("comfyui not in prompt, prompt:", prompt)
+                logger.debug("comfy_input not in prompt, prompt: %s", prompt)
         except json.JSONDecodeError:
-            return {"error": "Invalid JSON format in 'prompt'"}
+            return None, {"error": "Invalid JSON format in 'prompt'"}
     else:
-        return {"error": f"'prompt' must be a JSON object or a JSON-encoded string, job_input: {job_input}"}
+        return None, {"error": f"'prompt' must be a JSON object or a JSON-encoded string, job_input: {job_input}"}
 
-    print("Straing Queue ...")
-    print(f"Prompt: {prompt}")
+    print("Starting Queue ...")
+    logger.debug("Prompt: %s", prompt)
 
-    # Queue the prompt
+    # Connect to the websocket before queueing, so that no progress message is missed
+    client_id = str(uuid.uuid4())
     try:
-        queued_prompt = queue_prompt(prompt)
+        ws = await open_websocket(client_id)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"runpod-worker-comfy - websocket not available, polling instead: {str(e)}")
+        ws = None
 
-        print(f"Queued Prompt Return: {queued_prompt}")
-        prompt_id = queued_prompt["prompt_id"]
-        print(f"runpod-worker-comfy - queued prompt with ID {prompt_id}")
-    except Exception as e:
-        return {"error": f"Error queuing prompt: {str(e)}"}
-
-    # Poll for completion
-    print(f"\n\nrunpod-worker-comfy - wait until image generation is complete")
-    retries = 0
     try:
-        while retries < polling_max_retries:
-            history = get_history(prompt_id)
+        # Queue the prompt
+        try:
+            queued_prompt = await queue_prompt(prompt, client_id)
 
-            # Exit the loop if we have found the history
-            if prompt_id in history and history[prompt_id].get("outputs"):
-                break
-            else:
-                # Wait before trying again
-                time.sleep(COMFY_POLLING_INTERVAL_MS / 1000)
-                retries += 1
-        else:
-            return {"error": "Max retries reached while waiting for image generation"}
-    except Exception as e:
-        return {"error": f"Error waiting for image generation: {str(e)}"}
+            logger.debug("Queued prompt return: %s", queued_prompt)
+            prompt_id = queued_prompt["prompt_id"]
+            print(f"runpod-worker-comfy - queued prompt with ID {prompt_id}")
+        except Exception as e:
+            return None, {"error": f"Error queuing prompt: {str(e)}"}
+
+        # Wait for completion
+        print(f"\n\nrunpod-worker-comfy - wait until image generation is complete")
+        try:
+            # Keep the overall wait of the fixed-interval polling that was used before
+            history = await wait_for_history(prompt_id, ws, polling_max_retries * COMFY_POLLING_INTERVAL_MS / 1000)
+            if history is None:
+                return None, {"error": "Max retries reached while waiting for image generation"}
+        except Exception as e:
+            return None, {"error": f"Error waiting for image generation: {str(e)}"}
+    finally:
+        if ws is not None:
+            await ws.close()
+
+    outputs = history.get(prompt_id, {}).get("outputs")
+    if not outputs:
+        return None, {"error": "Image generation finished without any outputs"}
 
     logger.info("Runpod Handler function finished")
-    # Get the generated image and return it as URL in an AWS bucket or as base64
-    return process_output_images(history[prompt_id].get("outputs"), job["id"], output_path=output_path)
+    return outputs, None
+
+
+async def handler(job):
+    """
+    The main function that handles a job of generating an image.
+
+    This function validates the input, sends a prompt to ComfyUI for processing,
+    polls ComfyUI for result, and retrieves generated images.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Returns:
+        dict: A dictionary containing either an error message or a success status with generated images.
+    """
+    job_input = job["input"]
+
+    logger.info("Start handler, job id=%s", job.get("id"))
+    logger.debug("Job: %s", job)
+
+    # Resolve the settings once instead of storing them in the process-wide environment,
+    # which concurrent jobs would overwrite
+    config = build_job_config(job_input)
+    job_input.pop("bucket_creds", None)
+
+    outputs, error = await generate_images(job_input, config)
+    if error is not None:
+        return error
+
+    # Get the generated image and return it as URL in an AWS bucket or as base64.
+    # Uploading and encoding is blocking file/network I/O, so keep it off the event loop
+    return await asyncio.to_thread(process_output_images, outputs, job["id"], config)
+
+
+async def stream_handler(job):
+    """
+    Handle a job like handler, but stream base64 encoded images one per yielded result
+
+    Used instead of handler when STREAM_BASE64_IMAGES=1. Only one encoded image is held at a
+    time and /stream receives each as soon as it's encoded. RunPod collects the yielded results,
+    so /run and /runsync return a list of them. A yielded {"error": ...} stops the stream and
+    becomes the result of the job, which marks it as FAILED, while the error status of a
+    missing image is returned as part of the list.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Yields:
+        dict: A dictionary containing either an error message or a success status with generated images.
+    """
+    job_input = job["input"]
+
+    logger.info("Start stream handler, job id=%s", job.get("id"))
+    logger.debug("Job: %s", job)
+
+    config = build_job_config(job_input)
+    job_input.pop("bucket_creds", None)
+
+    outputs, error = await generate_images(job_input, config)
+    if error is not None:
+        yield error
+        return
+
+    if config.bucket_endpoint_url:
+        # The URLs are small enough to be returned at once
+        yield await asyncio.to_thread(process_output_images, outputs, job["id"], config)
+        return
+
+    async for result in stream_base64_images(outputs, config):
+        yield result
 
 
 # Start the handler only if this script is run directly
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
+    if os.environ.get("STREAM_BASE64_IMAGES", "0") == "1":
+        runpod.serverless.start({"handler": stream_handler, "return_aggregate_stream": True})
+    else:
+        runpod.serverless.start({"handler": handler})
@@ -1,77 +1,179 @@
 import unittest
-from unittest.mock import patch, MagicMock, mock_open, Mock
+from unittest.mock import patch, MagicMock, AsyncMock, ANY
 import sys
 import os
 import json
+import asyncio
+import base64
+from aiohttp import web
+import tempfile
 
 # Make sure that "src" is known and can be used to import rp_handler.py
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
 from src import rp_handler
+from runpod.serverless.modules import rp_job
 
 # Local folder for test resources
 RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES = "./test_resources/images"
 
 class TestRunpodWorkerComfy(unittest.TestCase):
-    @patch('rp_handler.requests.get')
-    def test_check_server_server_up(self, mock_requests):
+    def test_get_log_level(self):
+        self.assertEqual(rp_handler.get_log_level("debug"), "DEBUG")
+        self.assertEqual(rp_handler.get_log_level("WARNING"), "WARNING")
+        self.assertEqual(rp_handler.get_log_level("verbose"), "INFO")
+
+    @patch('src.rp_handler.get_session', new_callable=AsyncMock)
+    def test_check_server_server_up(self, mock_get_session):
         mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_requests.return_value = mock_response
+        mock_response.status = 200
+        mock_session = MagicMock()
+        mock_session.get.return_value.__aenter__.return_value = mock_response
+        mock_get_session.return_value = mock_session
 
-        result = rp_handler.check_server('http://127.0.0.1:8188', 1, 50)
+        result = asyncio.run(rp_handler.check_server('http://127.0.0.1:8188', 1, 50))
         self.assertTrue(result)
 
-    @patch('rp_handler.requests.get')
-    def test_check_server_server_down(self, mock_requests):
-        mock_requests.get.side_effect = rp_handler.requests.RequestException()
-        result = rp_handler.check_server('http://127.0.0.1:8188', 1, 50)
+    @patch('src.rp_handler.get_session', new_callable=AsyncMock)
+    def test_check_server_server_down(self, mock_get_session):
+        mock_session = MagicMock()
+        mock_session.get.side_effect = rp_handler.aiohttp.ClientError()
+        mock_get_session.return_value = mock_session
+
+        result = asyncio.run(rp_handler.check_server('http://127.0.0.1:8188', 1, 50))
         self.assertFalse(result)
 
-    @patch('rp_handler.urllib.request.urlopen')
-    def test_queue_prompt(self, mock_urlopen):
+    @patch('src.rp_handler.get_session', new_callable=AsyncMock)
+    def test_queue_prompt(self, mock_get_session):
         mock_response = MagicMock()
-        mock_response.read.return_value = json.dumps({"prompt_id": "123"}).encode()
-        mock_urlopen.return_value = mock_response
-        result = rp_handler.queue_prompt({"prompt": "test"})
+        mock_response.read = AsyncMock(return_value=json.dumps({"prompt_id": "123"}).encode())
+        mock_session = MagicMock()
+        mock_session.post.return_value.__aenter__.return_value = mock_response
+        mock_get_session.return_value = mock_session
+
+        result = asyncio.run(rp_handler.queue_prompt({"prompt": "test"}, "abc"))
         self.assertEqual(result, {"prompt_id": "123"})
+        sent = mock_session.post.call_args.kwargs["data"]
+        self.assertEqual(json.loads(sent), {"prompt": "test", "client_id": "abc"})
 
-    @patch('rp_handler.urllib.request.urlopen')
-    def test_get_history(self, mock_urlopen):
+    @patch('src.rp_handler.get_session', new_callable=AsyncMock)
+    def test_get_history(self, mock_get_session):
         # Mock response data as a JSON string
-        mock_response_data = json.dumps({"key": "value"}).encode('utf-8')
-
-        # Define a mock response function for `read`
-        def mock_read():
-            return mock_response_data
+        outputs = {"9": {"images": [{"filename": "ComfyUI_00001_.png"}]}}
+        mock_response_data = json.dumps({"123": {"prompt": [1, "123", {}], "outputs": outputs}}).encode('utf-8')
 
-        # Create a mock response object
-        mock_response = Mock()
-        mock_response.read = mock_read
+        # The response body is streamed from an async reader
+        class MockContent:
+            def __init__(self, data):
+                self.data = data
 
-        # Mock the __enter__ and __exit__ methods to support the context manager
-        mock_response.__enter__ = lambda s: s
-        mock_response.__exit__ = Mock()
+            async def read(self, size=-1):
+                size = len(self.data) if size < 0 else size
+                chunk, self.data = self.data[:size], self.data[size:]
+                return chunk
 
-        # Set the return value of the urlopen mock
-        mock_urlopen.return_value = mock_response
+        # Create a mock response object, used as an async context manager by the session
+        mock_response = MagicMock()
+        mock_response.content = MockContent(mock_response_data)
+        mock_session = MagicMock()
+        mock_session.get.return_value.__aenter__.return_value = mock_response
+        mock_get_session.return_value = mock_session
 
         # Call the function under test
-        result = rp_handler.get_history("123")
+        result = asyncio.run(rp_handler.get_history("123"))
 
         # Assertions
-        self.assertEqual(result, {"key": "value"})
-        mock_urlopen.assert_called_with("http://127.0.0.1:8188/history/123")
+        self.assertEqual(result, {"123": {"outputs": outputs}})
+        mock_session.get.assert_called_with("http://127.0.0.1:8188/history/123")
+
+    @patch('src.rp_handler.asyncio.sleep', new_callable=AsyncMock)
+    @patch('src.rp_handler.get_history', new_callable=AsyncMock)
+    def test_poll_history_backoff(self, mock_get_history, mock_sleep):
+        history = {"123": {"outputs": {"9": {"images": []}}}}
+        mock_get_history.side_effect = [{}, {"123": {}}, history]
+
+        result = asyncio.run(rp_handler.poll_history("123", 10))
 
-    @patch('builtins.open', new_callable=mock_open, read_data=b'test')
-    def test_base64_encode(self, mock_file):
-        result = rp_handler.base64_encode("dummy_path")
-        self.assertTrue(result.startswith("data:image/png;base64,"))
+        self.assertEqual(result, history)
+        self.assertEqual(mock_get_history.call_count, 3)
+        delays = [call.args[0] for call in mock_sleep.call_args_list]
+        self.assertEqual(len(delays), 2)
+        self.assertAlmostEqual(delays[0], 0.025)
+        self.assertAlmostEqual(delays[1], 0.025 * rp_handler.COMFY_POLLING_BACKOFF_FACTOR)
+
+    @patch('src.rp_handler.asyncio.sleep', new_callable=AsyncMock)
+    @patch('src.rp_handler.get_history', new_callable=AsyncMock)
+    def test_poll_history_timeout(self, mock_get_history, mock_sleep):
+        mock_get_history.return_value = {}
+
+        result = asyncio.run(rp_handler.poll_history("123", 0))
+
+        self.assertIsNone(result)
+        mock_get_history.assert_not_called()
+
+    def test_wait_for_execution(self):
+        def message(msg_type, data):
+            return MagicMock(type=rp_handler.aiohttp.WSMsgType.TEXT, data=json.dumps({"type": msg_type, "data": data}))
+
+        async def messages():
+            yield message("executing", {"node": "3", "prompt_id": "123"})
+            yield MagicMock(type=rp_handler.aiohttp.WSMsgType.BINARY, data=b"preview")
+            yield message("executing", {"node": None, "prompt_id": "other"})
+            yield message("executing", {"node": None, "prompt_id": "123"})
+
+        result = asyncio.run(rp_handler.wait_for_execution(messages(), "123"))
+        self.assertTrue(result)
 
-    @patch('rp_handler.os.path.exists')
-    @patch('rp_handler.rp_upload.upload_image')
+    @patch('src.rp_handler.poll_history', new_callable=AsyncMock)
+    @patch('src.rp_handler.get_history', new_callable=AsyncMock)
+    def test_wait_for_history_websocket_closed(self, mock_get_history, mock_poll_history):
+        history = {"123": {"outputs": {"9": {"images": []}}}}
+        mock_poll_history.return_value = history
+
+        async def messages():
+            yield MagicMock(type=rp_handler.aiohttp.WSMsgType.BINARY, data=b"preview")
+
+        result = asyncio.run(rp_handler.wait_for_history("123", messages(), 10))
+
+        # The websocket closed before the prompt was executed, so the history is polled instead
+        self.assertEqual(result, history)
+        mock_get_history.assert_not_called()
+        remaining = mock_poll_history.call_args.args[1]
+        self.assertTrue(0 < remaining <= 10)
+
+    @patch('src.rp_handler.poll_history', new_callable=AsyncMock)
+    @patch('src.rp_handler.get_history', new_callable=AsyncMock)
+    def test_wait_for_history_timeout(self, mock_get_history, mock_poll_history):
+        async def messages():
+            # The prompt is never executed
+            await asyncio.sleep(10)
+            yield
+
+        result = asyncio.run(rp_handler.wait_for_history("123", messages(), 0.05))
+
+        self.assertIsNone(result)
+        mock_get_history.assert_not_called()
+        mock_poll_history.assert_not_called()
+
+    def test_base64_encode(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_path = os.path.join(tmp_dir, "image.png")
+            with open(image_path, "wb") as image_file:
+                image_file.write(b'test')
+
+            result = rp_handler.base64_encode(image_path)
+        self.assertEqual(result, "data:image/png;base64,dGVzdA==")
+
+    def test_base64_encode_chunked(self):
+        image_path = f"{RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}/ComfyUI_00001_.png"
+        with open(image_path, "rb") as image_file:
+            expected = base64.b64encode(image_file.read()).decode("utf-8")
+
+        result = rp_handler.base64_encode(image_path)
+        self.assertEqual(result, f"data:image/png;base64,{expected}")
+
+    @patch('src.rp_handler.upload_image')
     @patch.dict(os.environ, {'COMFY_OUTPUT_PATH': RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES})
-    def test_bucket_endpoint_not_configured(self, mock_upload_image, mock_exists):
-        mock_exists.return_value = True
+    def test_bucket_endpoint_not_configured(self, mock_upload_image):
         mock_upload_image.return_value = 'simulated_uploaded/image.png'
         
         outputs = {'node_id': {'images': [{'filename': 'ComfyUI_00001_.png'}]}}
@@ -80,16 +182,13 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         result = rp_handler.process_output_images(outputs, job_id)
 
         self.assertEqual(result['status'], 'success')
-        self.assertTrue(result['message'].startswith("data:image/png;base64,"))
+        self.assertTrue(result['message'][0].startswith("data:image/png;base64,"))
+        mock_upload_image.assert_not_called()
 
-    @patch('rp_handler.os.path.exists')
-    @patch('rp_handler.rp_upload.upload_image')
+    @patch('src.rp_handler.upload_image')
     @patch.dict(os.environ, {'COMFY_OUTPUT_PATH': RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES, 'BUCKET_ENDPOINT_URL': 'http://example.com'})
-    def test_bucket_endpoint_configured(self, mock_upload_image, mock_exists):
-        # Mock the os.path.exists to return True, simulating that the image exists
-        mock_exists.return_value = True
-
-        # Mock the rp_upload.upload_image to return a simulated URL
+    def test_bucket_endpoint_configured(self, mock_upload_image):
+        # Mock upload_image to return a simulated URL
         mock_upload_image.return_value = 'http://example.com/uploaded/image.png'
 
         # Define the outputs and job_id for the test
@@ -101,22 +200,36 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         # Assertions
         self.assertEqual(result['status'], 'success')
-        self.assertEqual(result['message'], 'http://example.com/uploaded/image.png')
-        mock_upload_image.assert_called_once_with(job_id, './test_resources/images/ComfyUI_00001_.png')
+        self.assertEqual(result['message'], ['http://example.com/uploaded/image.png'])
+        mock_upload_image.assert_called_once_with(None, './test_resources/images/ComfyUI_00001_.png', ANY, boto_client=None)
 
+    @patch('src.rp_handler.upload_image')
+    @patch('src.rp_handler.get_bucket_client')
+    @patch.dict(os.environ, {'COMFY_OUTPUT_PATH': RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES, 'BUCKET_ENDPOINT_URL': 'http://example.com'})
+    def test_bucket_client_resolved_once(self, mock_get_bucket_client, mock_upload_image):
+        mock_client = MagicMock()
+        mock_get_bucket_client.return_value = mock_client
+        mock_upload_image.return_value = 'http://example.com/uploaded/image.png'
+        image = {'filename': 'ComfyUI_00001_.png'}
+        outputs = {'node_id': {'images': [image, image, image]}}
+
+        result = rp_handler.process_output_images(outputs, '123')
+
+        self.assertEqual(result['status'], 'success')
+        # The upload workers share the client instead of looking it up on their own
+        mock_get_bucket_client.assert_called_once()
+        self.assertEqual(mock_upload_image.call_count, 3)
+        for upload_call in mock_upload_image.call_args_list:
+            self.assertIs(upload_call.kwargs['boto_client'], mock_client)
 
-    @patch('rp_handler.os.path.exists')
-    @patch('rp_handler.rp_upload.upload_image')
+    @patch('src.rp_handler.upload_image')
     @patch.dict(os.environ, {
         'COMFY_OUTPUT_PATH': RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES,
         'BUCKET_ENDPOINT_URL': 'http://example.com',
         'BUCKET_ACCESS_KEY_ID': '',
         'BUCKET_SECRET_ACCESS_KEY': ''
     })
-    def test_bucket_image_upload_fails_env_vars_wrong_or_missing(self, mock_upload_image, mock_exists):
-        # Simulate the file existing in the output path
-        mock_exists.return_value = True
-
+    def test_bucket_image_upload_fails_env_vars_wrong_or_missing(self, mock_upload_image):
         # When AWS credentials are wrong or missing, upload_image should return 'simulated_uploaded/...'
         mock_upload_image.return_value = 'simulated_uploaded/image.png'
 
@@ -126,5 +239,319 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         result = rp_handler.process_output_images(outputs, job_id)
 
         # Check if the image was saved to the 'simulated_uploaded' directory
-        self.assertIn('simulated_uploaded', result['message'])
-        self.assertEqual(result['status'], 'success')
\ No newline at end of file
+        self.assertIn('simulated_uploaded', result['message'][0])
+        self.assertEqual(result['status'], 'success')
+
+    @patch.dict(os.environ, {
+        'BUCKET_ENDPOINT_URL': 'http://env.example.com',
+        'BUCKET_ACCESS_KEY_ID': 'env-id',
+        'BUCKET_SECRET_ACCESS_KEY': 'env-secret',
+        'BUCKET_NAME': 'env-bucket'
+    })
+    def test_build_job_config(self):
+        job_input = {
+            'output_path': 'outputs',
+            'bucket_creds': {'endpointUrl': 'http://job.example.com', 'accessId': 'job-id', 'accessSecret': 'job-secret'}
+        }
+
+        config = rp_handler.build_job_config(job_input)
+
+        self.assertEqual(config.bucket_endpoint_url, 'http://job.example.com')
+        self.assertEqual(config.bucket_access_key_id, 'job-id')
+        self.assertEqual(config.bucket_secret_access_key, 'job-secret')
+        self.assertEqual(config.bucket_name, 'env-bucket')
+        self.assertEqual(config.output_path, 'outputs')
+        self.assertEqual(os.environ['BUCKET_ENDPOINT_URL'], 'http://env.example.com')
+
+    @patch('src.rp_handler.boto3_session.Session')
+    def test_get_bucket_client_cached(self, mock_session):
+        rp_handler.get_bucket_client.cache_clear()
+        mock_session.return_value.client.side_effect = lambda *args, **kwargs: MagicMock()
+
+        client = rp_handler.get_bucket_client('https://bucket.s3.eu-central-1.amazonaws.com', 'id', 'secret')
+        self.assertIs(rp_handler.get_bucket_client('https://bucket.s3.eu-central-1.amazonaws.com', 'id', 'secret'), client)
+        self.assertIsNot(rp_handler.get_bucket_client('https://bucket.s3.eu-central-1.amazonaws.com', 'other-id', 'secret'), client)
+        self.assertEqual(mock_session.return_value.client.call_count, 2)
+
+        # The pool has room for all parts of all images uploaded at the same time
+        kwargs = mock_session.return_value.client.call_args.kwargs
+        self.assertEqual(
+            kwargs['config'].max_pool_connections,
+            rp_handler.IMAGE_WORKERS_MAX * rp_handler.UPLOAD_TRANSFER_CONFIG.max_concurrency
+        )
+        self.assertEqual(kwargs['region_name'], 'eu-central-1')
+        rp_handler.get_bucket_client.cache_clear()
+
+    def test_get_bucket_client_not_configured(self):
+        rp_handler.get_bucket_client.cache_clear()
+        self.assertIsNone(rp_handler.get_bucket_client('http://example.com', '', ''))
+        rp_handler.get_bucket_client.cache_clear()
+
+    @patch('src.rp_handler.secrets.token_hex', return_value='abcd1234')
+    @patch('src.rp_handler.get_bucket_client')
+    def test_upload_image(self, mock_get_bucket_client, mock_token_hex):
+        mock_client = MagicMock()
+        mock_client.generate_presigned_url.return_value = 'https://bucket/download'
+        mock_get_bucket_client.return_value = mock_client
+        config = rp_handler.JobConfig(
+            bucket_endpoint_url='http://example.com', bucket_access_key_id='id',
+            bucket_secret_access_key='secret', bucket_name='bucket'
+        )
+
+        result = rp_handler.upload_image('job', '/comfyui/output/image.jpg', config)
+
+        self.assertEqual(result, 'https://bucket/download')
+        mock_get_bucket_client.assert_called_once_with('http://example.com', 'id', 'secret')
+        mock_client.upload_file.assert_called_once_with(
+            '/comfyui/output/image.jpg',
+            'bucket',
+            'job/abcd1234.jpg',
+            ExtraArgs={'ContentType': 'image/jpeg'},
+            Config=rp_handler.UPLOAD_TRANSFER_CONFIG
+        )
+        mock_client.generate_presigned_url.assert_called_once_with(
+            'get_object', Params={'Bucket': 'bucket', 'Key': 'job/abcd1234.jpg'}, ExpiresIn=604800
+        )
+
+    @patch('src.rp_handler.secrets.token_hex', return_value='abcd1234')
+    @patch('src.rp_handler.get_bucket_client', return_value=None)
+    def test_upload_image_simulated(self, mock_get_bucket_client, mock_token_hex):
+        image_path = os.path.abspath(f"{RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}/ComfyUI_00001_.png")
+        cwd = os.getcwd()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            try:
+                result = rp_handler.upload_image('job', image_path, rp_handler.JobConfig())
+
+                self.assertEqual(result, 'simulated_uploaded/abcd1234.png')
+                with open(result, "rb") as uploaded, open(image_path, "rb") as original:
+                    self.assertEqual(uploaded.read(), original.read())
+            finally:
+                os.chdir(cwd)
+
+    @patch.dict(os.environ, {'COMFY_OUTPUT_PATH': './test_resources/missing'})
+    def test_process_output_images_missing_output_folder(self):
+        outputs = {'node_id': {'images': [{'filename': 'ComfyUI_00001_.png'}]}}
+        job_id = '123'
+
+        result = rp_handler.process_output_images(outputs, job_id)
+
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('./test_resources/missing/ComfyUI_00001_.png', result['message'])
+
+    @patch.dict(os.environ, {'COMFY_OUTPUT_PATH': RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES})
+    def test_process_output_images_missing_image(self):
+        outputs = {
+            'node_id': {'images': [{'filename': 'ComfyUI_00001_.png'}, {'filename': 'missing.png'}]}
+        }
+        job_id = '123'
+
+        result = rp_handler.process_output_images(outputs, job_id)
+
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('missing.png', result['message'])
+
+    @patch('src.rp_handler.upload_image')
+    @patch.dict(os.environ, {'COMFY_OUTPUT_PATH': RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES + '/', 'BUCKET_ENDPOINT_URL': 'http://example.com'})
+    def test_process_output_images_trailing_slash(self, mock_upload_image):
+        mock_upload_image.return_value = 'http://example.com/uploaded/image.png'
+        image = {'filename': 'ComfyUI_00001_.png'}
+
+        result = rp_handler.process_output_images({'node_id': {'images': [image]}}, '123')
+
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(mock_upload_image.call_args.args[1], './test_resources/images/ComfyUI_00001_.png')
+
+        result = rp_handler.process_output_images({'node_id': {'images': [image, {'filename': 'missing.png'}]}}, '123')
+
+        self.assertEqual(result['status'], 'error')
+        self.assertTrue(result['message'].endswith(' ./test_resources/images/missing.png'))
+
+    @patch('src.rp_handler._comfy_ready', True)
+    @patch('src.rp_handler.wait_for_history', new_callable=AsyncMock)
+    @patch('src.rp_handler.queue_prompt', new_callable=AsyncMock)
+    @patch('src.rp_handler.open_websocket', new_callable=AsyncMock)
+    @patch.dict(os.environ, {'COMFY_OUTPUT_PATH': RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES})
+    def test_handler_returns_base64_images(self, mock_open_websocket, mock_queue_prompt, mock_wait_for_history):
+        os.environ.pop('BUCKET_ENDPOINT_URL', None)
+        mock_open_websocket.side_effect = rp_handler.aiohttp.ClientError()
+        mock_queue_prompt.return_value = {"prompt_id": "123"}
+        image = {'filename': 'ComfyUI_00001_.png'}
+        mock_wait_for_history.return_value = {"123": {"outputs": {"9": {"images": [image, image]}}}}
+
+        result = asyncio.run(rp_handler.handler({"id": "job", "input": {"comfy_input": {}}}))
+
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(len(result['message']), 2)
+        self.assertTrue(result['message'][0].startswith("data:image/png;base64,"))
+
+    @patch('src.rp_handler._comfy_ready', True)
+    @patch('src.rp_handler.queue_prompt', new_callable=AsyncMock)
+    @patch('src.rp_handler.open_websocket', new_callable=AsyncMock)
+    def test_handler_returns_error(self, mock_open_websocket, mock_queue_prompt):
+        mock_open_websocket.side_effect = rp_handler.aiohttp.ClientError()
+        mock_queue_prompt.side_effect = rp_handler.aiohttp.ClientError("queue is down")
+
+        result = asyncio.run(rp_handler.handler({"id": "job", "input": {"comfy_input": {}}}))
+
+        self.assertEqual(result, {"error": "Error queuing prompt: queue is down"})
+
+    @patch('src.rp_handler._comfy_ready', True)
+    @patch('src.rp_handler.wait_for_history', new_callable=AsyncMock)
+    @patch('src.rp_handler.queue_prompt', new_callable=AsyncMock)
+    @patch('src.rp_handler.open_websocket', new_callable=AsyncMock)
+    @patch.dict(os.environ, {'COMFY_OUTPUT_PATH': RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES})
+    def test_stream_handler_streams_base64_images(self, mock_open_websocket, mock_queue_prompt, mock_wait_for_history):
+        os.environ.pop('BUCKET_ENDPOINT_URL', None)
+        mock_open_websocket.side_effect = rp_handler.aiohttp.ClientError()
+        mock_queue_prompt.return_value = {"prompt_id": "123"}
+        image = {'filename': 'ComfyUI_00001_.png'}
+        mock_wait_for_history.return_value = {"123": {"outputs": {"9": {"images": [image, image]}}}}
+
+        async def collect():
+            return [result async for result in rp_handler.stream_handler({"id": "job", "input": {"comfy_input": {}}})]
+
+        results = asyncio.run(collect())
+
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertEqual(result['status'], 'success')
+            self.assertTrue(result['message'].startswith("data:image/png;base64,"))
+
+    @patch('src.rp_handler._comfy_ready', False)
+    @patch('src.rp_handler.queue_prompt', new_callable=AsyncMock)
+    @patch('src.rp_handler.open_websocket', new_callable=AsyncMock)
+    @patch('src.rp_handler.check_server', new_callable=AsyncMock)
+    def test_handler_checks_server_until_ready(self, mock_check_server, mock_open_websocket, mock_queue_prompt):
+        mock_open_websocket.side_effect = rp_handler.aiohttp.ClientError()
+        mock_queue_prompt.side_effect = rp_handler.aiohttp.ClientError("queue is down")
+
+        def run_job():
+            return asyncio.run(rp_handler.handler({"id": "job", "input": {"comfy_input": {}}}))
+
+        # A failed probe is repeated by the next job
+        mock_check_server.return_value = False
+        run_job()
+        run_job()
+        self.assertEqual(mock_check_server.await_count, 2)
+
+        # Once the server was reachable it isn't probed again
+        mock_check_server.return_value = True
+        run_job()
+        run_job()
+        self.assertEqual(mock_check_server.await_count, 3)
+
+    def run_stream_job(self):
+        # Run stream_handler the way runpod does and return the result it sends for the job
+        config = {"handler": rp_handler.stream_handler, "return_aggregate_stream": True}
+        with patch('runpod.serverless.modules.rp_job.stream_result', new_callable=AsyncMock), \
+                patch('runpod.serverless.modules.rp_job.send_result', new_callable=AsyncMock) as mock_send_result:
+            asyncio.run(rp_job.handle_job(MagicMock(), config, {"id": "job", "input": {"comfy_input": {}}}))
+        return mock_send_result.call_args.args[1]
+
+    @patch('src.rp_handler._comfy_ready', True)
+    @patch('src.rp_handler.queue_prompt', new_callable=AsyncMock)
+    @patch('src.rp_handler.open_websocket', new_callable=AsyncMock)
+    def test_stream_handler_error_fails_job(self, mock_open_websocket, mock_queue_prompt):
+        mock_open_websocket.side_effect = rp_handler.aiohttp.ClientError()
+        mock_queue_prompt.side_effect = rp_handler.aiohttp.ClientError("down")
+
+        job_result = self.run_stream_job()
+
+        self.assertEqual(job_result, {"error": "Error queuing prompt: down"})
+
+    @patch('src.rp_handler._comfy_ready', True)
+    @patch('src.rp_handler.wait_for_history', new_callable=AsyncMock)
+    @patch('src.rp_handler.queue_prompt', new_callable=AsyncMock)
+    @patch('src.rp_handler.open_websocket', new_callable=AsyncMock)
+    @patch.dict(os.environ, {'COMFY_OUTPUT_PATH': RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES})
+    def test_stream_handler_missing_image_completes_job(self, mock_open_websocket, mock_queue_prompt, mock_wait_for_history):
+        os.environ.pop('BUCKET_ENDPOINT_URL', None)
+        mock_open_websocket.side_effect = rp_handler.aiohttp.ClientError()
+        mock_queue_prompt.return_value = {"prompt_id": "123"}
+        mock_wait_for_history.return_value = {"123": {"outputs": {"9": {"images": [{'filename': 'missing.png'}]}}}}
+
+        job_result = self.run_stream_job()
+
+        self.assertNotIn("error", job_result)
+        self.assertEqual(len(job_result["output"]), 1)
+        self.assertEqual(job_result["output"][0]["status"], "error")
+        self.assertIn("missing.png", job_result["output"][0]["message"])
+
+    @patch.dict(os.environ, {'COMFY_OUTPUT_PATH': RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES})
+    def test_handler_concurrent_jobs(self):
+        os.environ.pop('BUCKET_ENDPOINT_URL', None)
+        jobs = rp_handler.COMFY_CONNECTION_POOL_SIZE + 2
+        outputs = {"9": {"images": [{'filename': 'ComfyUI_00001_.png'}]}}
+
+        async def run_jobs():
+            # Minimal ComfyUI server that reports each prompt as executed once all jobs are queued
+            websockets = {}
+            queued = []
+            all_queued = asyncio.Event()
+
+            async def index(request):
+                return web.Response(text="ComfyUI")
+
+            async def ws_handler(request):
+                ws = web.WebSocketResponse()
+                await ws.prepare(request)
+                websockets[request.query["clientId"]] = ws
+                async for _ in ws:
+                    pass
+                return ws
+
+            async def prompt_handler(request):
+                body = await request.json()
+                prompt_id = f"prompt-{len(queued)}"
+                queued.append(prompt_id)
+                if len(queued) == jobs:
+                    all_queued.set()
+
+                async def execute():
+                    await all_queued.wait()
+                    await websockets[body["client_id"]].send_json(
+                        {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}}
+                    )
+
+                asyncio.ensure_future(execute())
+                return web.json_response({"prompt_id": prompt_id})
+
+            async def history_handler(request):
+                return web.json_response({request.match_info["prompt_id"]: {"outputs": outputs}})
+
+            app = web.Application()
+            app.router.add_get("/", index)
+            app.router.add_get("/ws", ws_handler)
+            app.router.add_post("/prompt", prompt_handler)
+            app.router.add_get("/history/{prompt_id}", history_handler)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+
+            try:
+                with patch('src.rp_handler.COMFY_HOST', f"127.0.0.1:{port}"), \
+                        patch('src.rp_handler._session', None), \
+                        patch('src.rp_handler._ws_session', None), \
+                        patch('src.rp_handler._session_lock', asyncio.Lock()), \
+                        patch('src.rp_handler._comfy_ready', False):
+                    try:
+                        return await asyncio.wait_for(asyncio.gather(*[
+                            rp_handler.handler({"id": f"job-{i}", "input": {"comfy_input": {"prompt": {}}}})
+                            for i in range(jobs)
+                        ]), 10)
+                    finally:
+                        for session in (rp_handler._session, rp_handler._ws_session):
+                            if session is not None:
+                                await session.close()
+            finally:
+                await runner.cleanup()
+
+        results = asyncio.run(run_jobs())
+
+        for result in results:
+            self.assertEqual(result['status'], 'success')
+            self.assertEqual(len(result['message']), 1)